@@ -2,3 +2,8 @@
 
 export SQLALCHEMY_DATABASE_URI="sqlite:////var/lib/formie/formie.db"
 export SECRET_KEY=""
+# Optional, space separated. Results of new forms are spread over these databases.
+# Only append to this list, existing forms refer to shards by their position.
+export FORMIE_SHARDS=""
+# Optional. Socket of live-relay.py, needed for live results when running multiple workers.
+export FORMIE_RELAY=""
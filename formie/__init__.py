@@ -4,7 +4,7 @@ from typing import TYPE_CHECKING
 import sqlalchemy
 from flask import redirect, render_template, url_for, Flask
 
-from formie import auth, forms, models
+from formie import auth, forms, live, models
 
 if TYPE_CHECKING:
     from flask.typing import ResponseReturnValue
@@ -16,7 +16,16 @@ def create_app() -> Flask:
     app = Flask(__name__, instance_relative_config=True)
     app.config["SQLALCHEMY_DATABASE_URI"] = os.environ["SQLALCHEMY_DATABASE_URI"]
     app.config["SECRET_KEY"] = os.environ["SECRET_KEY"]
+    # Results tables of new forms are spread over these databases by form id.
+    app.config["SQLALCHEMY_BINDS"] = {
+        f"shard{i}": uri
+        for i, uri in enumerate(os.environ.get("FORMIE_SHARDS", "").split())
+    }
+    app.config["FORMIE_SHARDS"] = list(app.config["SQLALCHEMY_BINDS"])
+    # Unix socket of live-relay.py, needed for live results with multiple workers.
+    app.config["FORMIE_RELAY"] = os.environ.get("FORMIE_RELAY")
     models.db.init_app(app)  # type: ignore[no-untyped-call]
+    live.init_app(app)
 
     app.register_blueprint(auth.bp)
     app.register_blueprint(forms.bp)
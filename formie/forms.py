@@ -1,14 +1,17 @@
 import csv
 import datetime
+import hashlib
 import io
 import json
 from collections import defaultdict
 from dataclasses import dataclass
 from enum import Flag
-from typing import cast, Type, TYPE_CHECKING, Union
+from typing import Any, cast, Iterator, Optional, Type, TYPE_CHECKING, Union
 
+import sqlalchemy
 from flask import (
     abort,
+    current_app,
     g,
     redirect,
     render_template,
@@ -23,7 +26,7 @@ if TYPE_CHECKING:
 else:
     ResponseReturnValue = "ResponseReturnValue"
 
-from formie import auth
+from formie import auth, live
 from formie.models import (
     db,
     Field,
@@ -40,6 +43,10 @@ bp = Blueprint("forms", __name__, url_prefix="/forms")
 
 JSONData = Union[str, int, bool, float, list["JSONData"], dict[str, "JSONData"]]
 
+# The largest valid schema, 64 fields of 64 choices with 64 astral characters each,
+# written as escaped surrogate pairs is about 3.2 MiB.
+MAX_SCHEMA_SIZE = 4 * 1024 * 1024
+
 
 class ACF(Flag):
     """Access control flags for forms. Can be used to limit viewing results/answering for other users."""
@@ -48,121 +55,177 @@ class ACF(Flag):
     DISALLOW_ANON_ANSWER = 0x2
 
 
-def validate_schema(data: JSONData) -> str:
-    """Validates the given schema. Returns a string with the error on fail."""
+def has_surrogates(text: str) -> bool:
+    """JSON allows lone surrogate escapes, but they can't be encoded into pages."""
+    if text.isascii():
+        return False
+
+    try:
+        text.encode()
+    except UnicodeEncodeError:
+        return True
+    return False
+
+
+def compile_schema(data: JSONData) -> tuple[list[Field], str]:
+    """Validates the given schema and builds its fields in a single pass without
+    modifying it. Returns the fields and an error string, which is empty on success."""
     if not isinstance(data, list):
-        return "Invalid schema root type."
+        return [], "Invalid schema root type."
 
     if len(data) == 0:
         # Disallow empty schemas.
-        return "Cannot make an empty form."
+        return [], "Cannot make an empty form."
 
     if len(data) > 64:
-        return f"Cannot have more than 64 fields."
+        return [], f"Cannot have more than 64 fields."
 
+    fields: list[Field] = []
     for i, field in enumerate(data):
         if not isinstance(field, dict):
-            return f"Invalid type for field #{i}"
-
-        if TYPE_CHECKING:
-            field = cast(dict[str, JSONData], field)
+            return [], f"Invalid type for field #{i}"
 
         if "type" not in field:
-            return f"Field #{i} needs a type."
+            return [], f"Field #{i} needs a type."
+
+        typ = field["type"]
 
-        if field["type"] == "info":
+        if typ == "info":
             if "text" not in field:
-                return f"Field #{i} needs information text."
+                return [], f"Field #{i} needs information text."
 
             if len(field) != 2:
-                return f"Field #{i} cannot have more than 2 attributes."
+                return [], f"Field #{i} cannot have more than 2 attributes."
 
-            if not isinstance(field["text"], str):
-                return f"Field #{i} has invalid text type."
+            text = field["text"]
+            if not isinstance(text, str):
+                return [], f"Field #{i} has invalid text type."
 
-            if len(field["text"]) > 512:
-                return f"Field #{i}'s information text cannot have more than 512 characters."
+            if len(text) > 512:
+                return (
+                    [],
+                    f"Field #{i}'s information text cannot have more than 512 characters.",
+                )
 
+            if has_surrogates(text):
+                return [], f"Field #{i}'s information text has invalid characters."
+
+            fields.append(InfoField(text=text))  # type: ignore[arg-type]
             continue
 
-        if (
-            "name" not in field
-            or not isinstance(field["name"], str)
-            or len(field["name"]) == 0
-        ):
-            return f"Field #{i} requires a question."
+        name = field.get("name")
+        if not isinstance(name, str) or len(name) == 0:
+            return [], f"Field #{i} requires a question."
+
+        if len(name) > 256:
+            return [], f"Field #{i}'s question cannot be longer than 256 characters."
 
-        if len(field["name"]) > 256:
-            return f"Field #{i}'s question cannot be longer than 256 characters."
+        if has_surrogates(name):
+            return [], f"Field #{i}'s question has invalid characters."
 
-        if field["type"] == "text":
+        if typ == "text":
             if "default" not in field:
-                return f"Field #{i} needs a default attribute."
+                return [], f"Field #{i} needs a default attribute."
 
-            if not isinstance(field["default"], str):
-                return f"Field #{i}'s default must be a string."
+            default = field["default"]
+            if not isinstance(default, str):
+                return [], f"Field #{i}'s default must be a string."
 
-            if len(field["default"]) > 1023:
-                return f"Field #{i}'s default cannot be longer than 1023 characters."
+            if len(default) > 1023:
+                return (
+                    [],
+                    f"Field #{i}'s default cannot be longer than 1023 characters.",
+                )
+
+            if has_surrogates(default):
+                return [], f"Field #{i}'s default has invalid characters."
 
             if len(field) != 3:
-                return f"Field #{i} cannot have more than 3 attributes."
-        elif field["type"] == "choice":
+                return [], f"Field #{i} cannot have more than 3 attributes."
+
+            fields.append(TextField(name=name, default=default))
+        elif typ == "choice":
             if "default" not in field:
-                return f"Field #{i} needs a default attribute."
+                return [], f"Field #{i} needs a default attribute."
 
-            if not isinstance(field["default"], int):
-                return f"Field #{i}'s default must be an integer."
+            default = field["default"]
+            if not isinstance(default, int):
+                return [], f"Field #{i}'s default must be an integer."
 
             if "single" not in field:
-                return f"Field #{i} needs a single attribute."
+                return [], f"Field #{i} needs a single attribute."
 
-            if not isinstance(field["single"], bool):
-                return f"Field #{i}'s single must be a boolean."
+            single = field["single"]
+
+            if not isinstance(single, bool):
+                return [], f"Field #{i}'s single must be a boolean."
 
             if "choices" not in field:
-                return f"Field #{i} needs a choices attribute"
+                return [], f"Field #{i} needs a choices attribute"
+
+            choices = field["choices"]
 
-            if not isinstance(field["choices"], list):
-                return f"Field #{i}'s choices must be a list."
+            if not isinstance(choices, list):
+                return [], f"Field #{i}'s choices must be a list."
 
-            if len(field["choices"]) > 64:
-                return f"Field #{i} cannot have more than 64 choices."
+            if len(choices) > 64:
+                return [], f"Field #{i} cannot have more than 64 choices."
 
-            if len(field["choices"]) == 0:
-                return f"Field #{i} needs at least one choice."
+            if len(choices) == 0:
+                return [], f"Field #{i} needs at least one choice."
 
-            for ci, choice in enumerate(field["choices"]):
+            for ci, choice in enumerate(choices):
                 if not isinstance(choice, str):
-                    return f"Field #{i} choice #{ci} must be a string."
+                    return [], f"Field #{i} choice #{ci} must be a string."
 
                 if len(choice) > 64:
                     return (
-                        f"Field #{i} choice #{ci} cannot have more than 64 characters."
+                        [],
+                        f"Field #{i} choice #{ci} cannot have more than 64 characters.",
                     )
 
+                if has_surrogates(choice):
+                    return [], f"Field #{i} choice #{ci} has invalid characters."
+
             if len(field) != 5:
-                return f"Field #{i} cannot have more than 5 attributes."
-        elif field["type"] == "range":
+                return [], f"Field #{i} cannot have more than 5 attributes."
+
+            fields.append(
+                ChoiceField(
+                    name=name,
+                    single=single,
+                    default=default,
+                    choices=list(choices),  # type: ignore[arg-type]
+                )
+            )
+        elif typ == "range":
+            bounds: list[int] = []
             for attr in ("default", "min", "max"):
                 if attr not in field:
-                    return f"Field #{i} needs a {attr} attribute."
+                    return [], f"Field #{i} needs a {attr} attribute."
+
+                value = field[attr]
 
-                if not isinstance(field[attr], int):
-                    return f"Field #{i} must be an integer."
+                if not isinstance(value, int):
+                    return [], f"Field #{i} must be an integer."
 
-            if field["default"] < field["min"]:
-                return f"Field #{i}'s default cannot be lower than minimum."
+                bounds.append(value)
 
-            if field["default"] > field["max"]:
-                return f"Field #{i}'s default cannot be higher than maximum."
+            default, low, high = bounds
+            if default < low:
+                return [], f"Field #{i}'s default cannot be lower than minimum."
+
+            if default > high:
+                return [], f"Field #{i}'s default cannot be higher than maximum."
 
             if len(field) != 5:
-                return f"Field #{i} cannot have more than 5 attributes."
+                return [], f"Field #{i} cannot have more than 5 attributes."
+
+            fields.append(RangeField(name=name, default=default, min=low, max=high))
         else:
-            return f"Field #{i} has an invalid type."
+            return [], f"Field #{i} has an invalid type."
 
-    return ""
+    return fields, ""
 
 
 def validate_answer(schema: list[Field], form: dict[str, str]) -> str:
@@ -217,73 +280,72 @@ def validate_answer(schema: list[Field], form: dict[str, str]) -> str:
     return ""
 
 
-def decode_fields(data: list[dict[str, JSONData]]) -> list[Field]:
-    fields: list[Field] = []
-    for elem in data:
-        assert isinstance(elem["type"], str)
+FIELDS: dict[str, list[Field]] = {}
 
-        if elem["type"] == "text":
-            del elem["type"]
 
-            assert isinstance(elem["default"], str)
+def schema_hash(data: JSONData) -> str:
+    """Hashes the canonical encoding of a schema, so identical schemas get the same hash."""
+    # ASCII output escapes lone surrogates, which JSON allows but UTF-8 can't encode.
+    canonical = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
 
-            fields.append(TextField(name=elem["name"], default=elem["default"]))
 
-            elem["type"] = "text"
-        elif elem["type"] == "choice":
-            del elem["type"]
+def decode_fields(data: JSONData) -> list[Field]:
+    """Builds the fields of a stored, already validated schema."""
+    fields, error = compile_schema(data)
+    assert not error, error
+    return fields
 
-            assert isinstance(elem["single"], bool)
-            assert isinstance(elem["default"], int)
-            assert isinstance(elem["choices"], list)
 
-            fields.append(ChoiceField(name=elem["name"], single=elem["single"], default=elem["default"], choices=elem["choices"]))  # type: ignore[arg-type]
-            elem["type"] = "choice"
-        elif elem["type"] == "range":
-            del elem["type"]
+def get_fields(form: Form, schema: JSONData) -> list[Field]:
+    """Returns the fields of a form, shared between forms with identical schemas."""
+    if form.schema_hash is None:
+        return decode_fields(schema)
 
-            assert isinstance(elem["default"], int)
-            assert isinstance(elem["min"], int)
-            assert isinstance(elem["max"], int)
+    if form.schema_hash not in FIELDS:
+        FIELDS[form.schema_hash] = decode_fields(schema)
+    return FIELDS[form.schema_hash]
 
-            fields.append(
-                RangeField(
-                    name=elem["name"],
-                    default=elem["default"],
-                    min=elem["min"],
-                    max=elem["max"],
-                )
-            )
-            elem["type"] = "range"
-        elif elem["type"] == "info":
-            assert isinstance(elem["text"], str)
 
-            fields.append(InfoField(text=elem["text"]))
+MODELS: dict[tuple[str, Optional[str]], Type[Model]] = {}
 
-    return fields
 
+def pick_shard(form_id: int) -> Optional[str]:
+    """Picks the bind that will hold a new form's results. Returns None if sharding is disabled."""
+    shards: list[str] = current_app.config["FORMIE_SHARDS"]
+    if not shards:
+        return None
 
-MODELS: dict[str, Type[Model]] = {}
+    return shards[form_id % len(shards)]
 
 
-def create_model(name: str, fields: list[Field]) -> Type[Model]:
-    if name in MODELS:
-        return MODELS[name]
+def create_model(
+    name: str, fields: list[Field], shard: Optional[str] = None
+) -> Type[Model]:
+    # Forms can move between shards while we are running, so there is a model per
+    # shard. Each gets its own metadata since they all share the same table name.
+    if (name, shard) in MODELS:
+        return MODELS[(name, shard)]
 
-    cols = {"id": db.Column(db.Integer, primary_key=True)}
+    cols = [db.Column("id", db.Integer, primary_key=True)]
     for i, field in enumerate(fields):
         if isinstance(field, InfoField):
             continue
 
         if isinstance(field, TextField):
-            col = db.Column(db.Text, default=field.default)
+            col = db.Column(f"col{i}", db.Text, default=field.default)
         elif isinstance(field, ChoiceField):
-            col = db.Column(db.Integer, default=field.default)
+            col = db.Column(f"col{i}", db.Integer, default=field.default)
         elif isinstance(field, RangeField):
-            col = db.Column(db.Integer, default=field.default)
-        cols[f"col{i}"] = col
-    cls = type(name, (db.Model,), cols)  # type: ignore[arg-type]
-    MODELS[name] = cls
+            col = db.Column(f"col{i}", db.Integer, default=field.default)
+        cols.append(col)
+    table = db.Table(name, sqlalchemy.MetaData(), *cols)
+    cls = type(
+        name if shard is None else f"{name}_{shard}",
+        (db.Model,),
+        {"__table__": table, "__bind_key__": shard},
+    )
+    MODELS[(name, shard)] = cls
     return cls
 
 
@@ -310,27 +372,45 @@ def new_form() -> ResponseReturnValue:
         if request.args.get("disallow_anon_answer", "false") == "true":
             acf |= ACF.DISALLOW_ANON_ANSWER
 
-        schema = request.json
-        if schema is None:
+        if not request.is_json:
             return "A JSON Body is required", 400
 
-        error = validate_schema(cast(JSONData, schema))
+        # Chunked bodies have no length, so the read is capped as well.
+        if (request.content_length or 0) > MAX_SCHEMA_SIZE:
+            return "Schema is too large.", 413
+
+        raw = request.stream.read(MAX_SCHEMA_SIZE + 1)
+        if len(raw) > MAX_SCHEMA_SIZE:
+            return "Schema is too large.", 413
+
+        try:
+            schema_str = raw.decode()
+            schema = json.loads(schema_str)
+        except (ValueError, RecursionError):
+            return "Invalid JSON body.", 400
+
+        fields, error = compile_schema(schema)
 
         if error:
             return error, 400
 
+        digest = schema_hash(schema)
+        fields = FIELDS.setdefault(digest, fields)
+
         try:
-            schema_str = json.dumps(schema)  # TODO: fetch original instead
-            fields = decode_fields(cast(list[dict[str, JSONData]], schema))
             form = Form(
                 schema=schema_str,
+                schema_hash=digest,
                 created_at=datetime.datetime.now(),
                 creator_id=g.user.id,
                 access_control_flags=acf.value,
             )
             db.session.add(form)
             db.session.commit()
-            create_model(str(form.id), fields).__table__.create(db.engine)
+            form.shard = pick_shard(form.id)
+            create_model(str(form.id), fields, form.shard).__table__.create(
+                db.get_engine(bind=form.shard)
+            )
         except Exception as e:
             raise e
             abort(401)
@@ -347,7 +427,8 @@ def form(form_id: int) -> ResponseReturnValue:
         abort(404)
     schema = json.loads(form.schema)
 
-    model = create_model(str(form.id), decode_fields(schema.copy()))
+    fields = get_fields(form, schema)
+    model = create_model(str(form.id), fields, form.shard)
 
     if request.method == "POST":
         if (
@@ -356,7 +437,7 @@ def form(form_id: int) -> ResponseReturnValue:
         ):
             abort(403)  # TODO: Better pages for aborts
 
-        error = validate_answer(decode_fields(schema), request.form)
+        error = validate_answer(fields, request.form)
         if error:
             return error, 400
 
@@ -382,8 +463,14 @@ def form(form_id: int) -> ResponseReturnValue:
             except ValueError:
                 pass
 
-        db.session.add(model(**values))  # type: ignore[arg-type]
+        res = model(**values)  # type: ignore[arg-type]
+        db.session.add(res)
+        # Build the event before committing, reading res afterwards would reload it.
+        db.session.flush()
+        answer = answer_values(fields, values)
+        event = {"row": format_result(fields, res.id, answer), "values": answer}
         db.session.commit()
+        live.get_broker().publish(form.id, event)
 
         if url := request.args.get("goto", None):
             return redirect(url)
@@ -407,8 +494,54 @@ def form(form_id: int) -> ResponseReturnValue:
     return render_template("forms/form.html", schema=schema)
 
 
-@bp.route("/<int:form_id>/results")
-def view_results(form_id: int) -> ResponseReturnValue:
+def result_values(fields: list[Field], res: Model) -> dict[str, Any]:
+    return {
+        f"col{i}": getattr(res, f"col{i}")
+        for i, field in enumerate(fields)
+        if not isinstance(field, InfoField)
+    }
+
+
+def answer_values(
+    fields: list[Field], form_values: dict[str, Union[int, str]]
+) -> dict[str, Any]:
+    """Returns the values of a new result as they are stored, defaults included."""
+    values: dict[str, Any] = {}
+    for i, field in enumerate(fields):
+        if isinstance(field, InfoField):
+            continue
+
+        value = form_values.get(f"col{i}", field.default)
+        values[f"col{i}"] = value if isinstance(field, TextField) else int(value)
+    return values
+
+
+def format_result(
+    fields: list[Field], result_id: int, values: dict[str, Any]
+) -> list[Any]:
+    """Formats a result as a results table row."""
+    cols = [result_id]
+    for i, field in enumerate(fields):
+        if isinstance(field, InfoField):
+            continue
+
+        if not isinstance(field, ChoiceField):
+            cols.append(values[f"col{i}"])
+        else:
+            if field.single:
+                cols.append(field.choices[int(values[f"col{i}"])])
+            else:
+                answer_flag: int = int(values[f"col{i}"])
+                answer: list[str] = []
+                for choice_index, choice in enumerate(field.choices):
+                    if answer_flag & (1 << choice_index):
+                        answer.append(choice)
+                cols.append("+".join(answer))
+    return cols
+
+
+def get_results_form(form_id: int) -> Form:
+    """Fetches a form whose results the current user may view, aborts otherwise."""
     form = Form.query.filter_by(id=form_id).first()
     if form is None:
         abort(404)
@@ -418,29 +551,20 @@ def view_results(form_id: int) -> ResponseReturnValue:
     ):
         abort(403)
 
+    return form
+
+
+@bp.route("/<int:form_id>/results")
+def view_results(form_id: int) -> ResponseReturnValue:
+    form = get_results_form(form_id)
+
     schema = json.loads(form.schema)
-    fields = decode_fields(schema)
-    model = create_model(str(form.id), fields)
-    results = []
-    for res in model.query.all():
-        cols = [res.id]
-        for i, field in enumerate(fields):
-            if isinstance(field, InfoField):
-                continue
-
-            if not isinstance(field, ChoiceField):
-                cols.append(getattr(res, f"col{i}"))
-            else:
-                if field.single:
-                    cols.append(field.choices[int(getattr(res, f"col{i}"))])
-                else:
-                    answer_flag: int = int(getattr(res, f"col{i}"))
-                    answer: list[str] = []
-                    for choice_index, choice in enumerate(field.choices):
-                        if answer_flag & (1 << choice_index):
-                            answer.append(choice)
-                    cols.append("+".join(answer))
-        results.append(cols)
+    fields = get_fields(form, schema)
+    model = create_model(str(form.id), fields, form.shard)
+    results = [
+        format_result(fields, res.id, result_values(fields, res))
+        for res in model.query.all()
+    ]
 
     if request.args.get("format", default=None, type=str) == "csv":
         buf = io.StringIO()
@@ -448,4 +572,52 @@ def view_results(form_id: int) -> ResponseReturnValue:
         buf.seek(0)
         return cast(Union[Response, str], Response(buf.read(), mimetype="text/csv"))
 
-    return render_template("forms/results.html", schema=schema, results=results)
+    return render_template(
+        "forms/results.html",
+        schema=schema,
+        results=results,
+        stream_url=url_for(
+            "forms.stream_results",
+            form_id=form_id,
+            after=max((row[0] for row in results), default=0),
+        ),
+    )
+
+
+@bp.route("/<int:form_id>/results/stream")
+def stream_results(form_id: int) -> ResponseReturnValue:
+    """Server-sent events with the new results and aggregates of a form. Results
+    after the given id, or the Last-Event-ID of a reconnecting browser, are replayed."""
+    form = get_results_form(form_id)
+    try:
+        after = int(request.headers.get("Last-Event-ID", request.args.get("after", 0)))
+    except ValueError:
+        abort(400)
+
+    fields = get_fields(form, json.loads(form.schema))
+    model = create_model(str(form.id), fields, form.shard)
+    broker = live.get_broker()
+    subscription = broker.subscribe(
+        form.id,
+        fields,
+        lambda: ((res.id, result_values(fields, res)) for res in model.query.all()),
+    )
+    # Subscribed first, so answers committed during this query are not missed.
+    replay = [
+        format_result(fields, res.id, result_values(fields, res))
+        for res in model.query.filter(model.id > after).order_by(model.id)
+    ]
+
+    def stream() -> Iterator[str]:
+        try:
+            for row in replay:
+                yield live.format_event("result", {"row": row}, row[0])
+            yield from subscription.stream(after, {row[0] for row in replay})
+        finally:
+            broker.unsubscribe(subscription)
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
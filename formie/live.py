@@ -0,0 +1,381 @@
+import hmac
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+from flask import current_app, Flask
+
+from formie.models import ChoiceField, Field, RangeField
+
+# Events kept for a viewer that can't keep up, older ones are dropped first.
+SUBSCRIBER_BUFFER = 64
+HEARTBEAT_INTERVAL = 15.0
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30.0
+
+logger = logging.getLogger(__name__)
+
+Event = dict[str, Any]
+
+
+def format_event(name: str, data: Any, event_id: Optional[int] = None) -> str:
+    if event_id is None:
+        return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+    return f"id: {event_id}\nevent: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+class Tally:
+    """Running aggregates of a form's results, updated one answer at a time."""
+
+    def __init__(self, fields: list[Field]) -> None:
+        self.fields = fields
+        self.count = 0
+        self.choices: dict[str, list[int]] = {}
+        self.sums: dict[str, int] = {}
+        for i, field in enumerate(fields):
+            if isinstance(field, ChoiceField):
+                self.choices[f"col{i}"] = [0] * len(field.choices)
+            elif isinstance(field, RangeField):
+                self.sums[f"col{i}"] = 0
+
+    def add(self, values: dict[str, Any]) -> None:
+        self.count += 1
+        for i, field in enumerate(self.fields):
+            value = values.get(f"col{i}")
+            if value is None:
+                continue
+
+            if isinstance(field, ChoiceField):
+                counts = self.choices[f"col{i}"]
+                if field.single:
+                    counts[int(value)] += 1
+                else:
+                    for choice_index in range(len(counts)):
+                        if int(value) & (1 << choice_index):
+                            counts[choice_index] += 1
+            elif isinstance(field, RangeField):
+                self.sums[f"col{i}"] += int(value)
+
+    def summary(self) -> Event:
+        fields: dict[str, Any] = dict(self.choices)
+        for col, total in self.sums.items():
+            fields[col] = total / self.count if self.count else None
+        return {"count": self.count, "fields": fields}
+
+
+class Subscription:
+    def __init__(self, form_id: int) -> None:
+        self.form_id = form_id
+        # A None payload ends the stream.
+        self.queue: queue.Queue[tuple[Optional[int], Optional[str]]] = queue.Queue(
+            SUBSCRIBER_BUFFER
+        )
+
+    def push(self, event_id: Optional[int], payload: Optional[str]) -> None:
+        """Queues an event without blocking, dropping the oldest one if the buffer is full."""
+        while True:
+            try:
+                self.queue.put_nowait((event_id, payload))
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def stream(self, after: int, sent: set[int]) -> Iterator[str]:
+        """Yields the queued events, skipping results the viewer already has:
+        the ones up to after and the ones in sent."""
+        while True:
+            try:
+                event_id, payload = self.queue.get(timeout=HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                # Keeps proxies from closing the connection, and lets us notice gone viewers.
+                yield ": heartbeat\n\n"
+                continue
+
+            if payload is None:
+                return
+
+            if event_id is not None and (event_id <= after or event_id in sent):
+                continue
+
+            yield payload
+
+
+class _Channel:
+    def __init__(self) -> None:
+        # None while the first viewer is seeding it.
+        self.tally: Optional[Tally] = None
+        # Answers up to this id were counted by the seeding scan.
+        self.seeded_id = 0
+        # Answers delivered while seeding, counted once the tally is ready.
+        self.pending: list[Event] = []
+        self.subscribers: set[Subscription] = set()
+
+
+class Broker:
+    """In-process pub/sub for committed answers. Each answer is formatted once and
+    fanned out to every viewer of the form."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.channels: dict[int, _Channel] = {}
+
+    def subscribe(
+        self,
+        form_id: int,
+        fields: list[Field],
+        load: Callable[[], Iterable[tuple[int, dict[str, Any]]]],
+    ) -> Subscription:
+        """Subscribes to a form. load is only called for the first viewer of a form,
+        to seed the aggregates with the ids and values of the existing results. It
+        runs without the lock held, so answers keep flowing meanwhile."""
+        subscription = Subscription(form_id)
+        with self.lock:
+            channel = self.channels.get(form_id)
+            seed = channel is None
+            if channel is None:
+                channel = self.channels[form_id] = _Channel()
+
+            channel.subscribers.add(subscription)
+            if channel.tally is not None:
+                subscription.push(
+                    None, format_event("summary", channel.tally.summary())
+                )
+
+        if not seed:
+            return subscription
+
+        tally = Tally(fields)
+        seeded_id = 0
+        try:
+            for result_id, values in load():
+                tally.add(values)
+                seeded_id = max(seeded_id, result_id)
+        except BaseException:
+            with self.lock:
+                if self.channels.get(form_id) is channel:
+                    del self.channels[form_id]
+            raise
+
+        with self.lock:
+            channel.tally = tally
+            channel.seeded_id = seeded_id
+            summary = format_event("summary", tally.summary())
+            for subscriber in channel.subscribers:
+                subscriber.push(None, summary)
+
+            for event in channel.pending:
+                self.fan_out(channel, event)
+            channel.pending.clear()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self.lock:
+            channel = self.channels.get(subscription.form_id)
+            if channel is None or subscription not in channel.subscribers:
+                return
+
+            channel.subscribers.remove(subscription)
+            if not channel.subscribers:
+                del self.channels[subscription.form_id]
+
+    def reset(self) -> None:
+        """Ends every stream and forgets the aggregates. Browsers reconnect by
+        themselves, and the aggregates are seeded again by the next viewer."""
+        with self.lock:
+            for channel in self.channels.values():
+                for subscription in channel.subscribers:
+                    subscription.push(None, None)
+            self.channels.clear()
+
+    def publish(self, form_id: int, event: Event) -> None:
+        """Publishes a committed answer. event has the formatted "row", which starts
+        with the result id, and the raw "values"."""
+        self.deliver(form_id, event)
+
+    def deliver(self, form_id: int, event: Event) -> None:
+        with self.lock:
+            channel = self.channels.get(form_id)
+            if channel is None:
+                return
+
+            if channel.tally is None:
+                channel.pending.append(event)
+                return
+
+            self.fan_out(channel, event)
+
+    def fan_out(self, channel: _Channel, event: Event) -> None:
+        """Counts an answer and pushes it to the viewers. Must be called with the lock held."""
+        assert channel.tally is not None
+        result_id: int = event["row"][0]
+        if result_id > channel.seeded_id:
+            channel.tally.add(event["values"])
+
+        payload = format_event(
+            "result",
+            {"row": event["row"], "aggregates": channel.tally.summary()},
+            result_id,
+        )
+        for subscription in channel.subscribers:
+            subscription.push(result_id, payload)
+
+
+class RelayBroker(Broker):
+    """Broker that shares answers between worker processes through a relay started
+    with serve_relay. While the relay is unreachable, other workers' answers are
+    missed, so streams are reset to have their aggregates seeded again."""
+
+    def __init__(self, address: str, authkey: bytes) -> None:
+        super().__init__()
+        self.address = address
+        self.authkey = authkey
+        self.send_lock = threading.Lock()
+        self.conn: Optional[Connection] = None
+        self.pid = 0
+
+    def dial(self) -> Optional[Connection]:
+        try:
+            return Client(self.address, authkey=self.authkey)
+        except (OSError, AuthenticationError) as e:
+            logger.warning("cannot connect to the live relay: %s", e)
+            return None
+
+    def start(self) -> None:
+        """Connects and starts the receiving thread, once per process since
+        connections and threads don't survive forking."""
+        with self.send_lock:
+            if self.pid == os.getpid():
+                return
+
+            self.pid = os.getpid()
+            self.conn = self.dial()
+            threading.Thread(
+                target=self.receive, args=(self.conn,), daemon=True
+            ).start()
+
+    def receive(self, conn: Optional[Connection]) -> None:
+        delay = RECONNECT_DELAY
+        while True:
+            if conn is None:
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                conn = self.dial()
+                if conn is None:
+                    continue
+
+                delay = RECONNECT_DELAY
+                with self.send_lock:
+                    self.conn = conn
+                # Answers published while disconnected were missed.
+                self.reset()
+
+            try:
+                self.read(conn)
+            finally:
+                with self.send_lock:
+                    if self.conn is conn:
+                        self.conn = None
+                conn.close()
+                conn = None
+                # Viewers would silently stop getting other workers' answers.
+                self.reset()
+
+    def read(self, conn: Connection) -> None:
+        """Delivers the answers coming from the relay until the connection drops."""
+        while True:
+            try:
+                message = conn.recv_bytes()
+            except (EOFError, OSError):
+                return
+
+            try:
+                form_id, event = json.loads(message)
+                self.deliver(form_id, event)
+            except Exception:
+                logger.exception("dropping a bad message from the live relay")
+
+    def subscribe(
+        self,
+        form_id: int,
+        fields: list[Field],
+        load: Callable[[], Iterable[tuple[int, dict[str, Any]]]],
+    ) -> Subscription:
+        self.start()
+        return super().subscribe(form_id, fields, load)
+
+    def publish(self, form_id: int, event: Event) -> None:
+        self.start()
+        with self.send_lock:
+            if self.conn is not None:
+                try:
+                    self.conn.send_bytes(json.dumps([form_id, event]).encode())
+                    return
+                except OSError:
+                    pass
+
+        logger.warning("live relay unreachable, resetting live results")
+        self.reset()
+
+
+def relay_key(secret_key: str) -> bytes:
+    """Derives the key workers and the relay authenticate each other with."""
+    return hmac.new(secret_key.encode(), b"formie live relay", "sha256").digest()
+
+
+def serve_relay(address: str, authkey: bytes) -> None:
+    """Forwards every message from a worker to all connected workers, including the sender."""
+    clients: list[Connection] = []
+    lock = threading.Lock()
+
+    def forward(conn: Connection) -> None:
+        while True:
+            try:
+                message = conn.recv_bytes()
+            except (EOFError, OSError):
+                break
+
+            with lock:
+                for client in list(clients):
+                    try:
+                        client.send_bytes(message)
+                    except OSError:
+                        clients.remove(client)
+
+        with lock:
+            if conn in clients:
+                clients.remove(conn)
+
+    with Listener(address, authkey=authkey) as listener:
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, EOFError, AuthenticationError) as e:
+                logger.warning("rejected a live relay client: %s", e)
+                continue
+
+            with lock:
+                clients.append(conn)
+            threading.Thread(target=forward, args=(conn,), daemon=True).start()
+
+
+def init_app(app: Flask) -> None:
+    address = app.config.get("FORMIE_RELAY")
+    app.extensions["formie_live"] = (
+        RelayBroker(address, relay_key(app.config["SECRET_KEY"]))
+        if address
+        else Broker()
+    )
+
+
+def get_broker() -> Broker:
+    broker: Broker = current_app.extensions["formie_live"]
+    return broker
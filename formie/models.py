@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Any, TYPE_CHECKING
+from typing import Any, Optional, TYPE_CHECKING
 
 from flask_sqlalchemy import SQLAlchemy
 
@@ -46,9 +46,17 @@ class User(Model):
 class Form(Model):
     id: int = db.Column(db.Integer, primary_key=True)
     schema: str = db.Column(db.Text)
+    schema_hash: Optional[str] = db.Column(db.Text)
     created_at: Any = db.Column(db.DateTime)
     creator_id: int = db.Column(db.Integer, db.ForeignKey(User.id))
     access_control_flags: int = db.Column(db.Integer, nullable=False, default=0)
+    # Bind key of the results table, None for the main database.
+    shard: Optional[str] = db.Column(db.Text)
+    # Set while rebalance-shard.py moves the results, "default" is the main database.
+    moving_from: Optional[str] = db.Column(db.Text)
+    moving_to: Optional[str] = db.Column(db.Text)
+    # Last result id copied from moving_from, set once the form switched shards.
+    moved_id: Optional[int] = db.Column(db.Integer)
 
     creator: User = db.relationship("User", foreign_keys="Form.creator_id")
 
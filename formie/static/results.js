@@ -0,0 +1,35 @@
+let results_table = document.getElementById('results');
+let result_count = document.getElementById('result_count');
+let aggregates_list = document.getElementById('aggregates');
+
+let source = new EventSource(results_table.dataset.stream);
+
+function show_aggregates(aggregates) {
+	result_count.textContent = `${aggregates.count} answers`;
+	for (const item of aggregates_list.children) {
+		let value = aggregates.fields[item.dataset.col];
+		if (item.dataset.choices) {
+			let choices = JSON.parse(item.dataset.choices);
+			let counts = choices.map((choice, i) => `${choice}: ${value[i]}`);
+			item.textContent = `${item.dataset.name} - ${counts.join(', ')}`;
+		} else if (value === null) {
+			item.textContent = `${item.dataset.name} - no answers`;
+		} else {
+			item.textContent = `${item.dataset.name} - average ${value.toFixed(2)}`;
+		}
+	}
+}
+
+source.addEventListener('summary', (e) => {
+	show_aggregates(JSON.parse(e.data));
+});
+
+source.addEventListener('result', (e) => {
+	let result = JSON.parse(e.data);
+	let row = results_table.insertRow();
+	for (const col of result.row) {
+		row.insertCell().textContent = ` ${col} `;
+	}
+	// Replayed results don't carry aggregates, a summary follows them.
+	if (result.aggregates) show_aggregates(result.aggregates);
+});
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+from formie import live
+
+
+def main() -> None:
+    try:
+        address: str = sys.argv[1]
+    except IndexError:
+        print(f"USAGE: {sys.argv[0]} <socket path>")
+        print()
+        print("Relays live results between workers. Point FORMIE_RELAY at the socket.")
+        print("Needs the same SECRET_KEY as the workers.")
+        sys.exit(1)
+
+    live.serve_relay(address, live.relay_key(os.environ["SECRET_KEY"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import json
+import sys
+import time
+from typing import Any, Optional
+
+import sqlalchemy
+from flask import current_app
+
+from formie import create_app, forms, models
+
+BATCH_SIZE = 1000
+
+
+def copy_batch(
+    table: Any, src: Any, dst: Any, after: int, keep_ids: bool
+) -> Optional[int]:
+    """Copies a batch of the rows of table with an id above after from src to dst.
+    Returns the last copied id, None if there was nothing to copy."""
+    with src.connect() as conn:
+        rows = conn.execute(
+            table.select()
+            .where(table.c.id > after)
+            .order_by(table.c.id)
+            .limit(BATCH_SIZE)
+        ).all()
+
+    if not rows:
+        return None
+
+    values = [dict(row._mapping) for row in rows]
+    if not keep_ids:
+        for value in values:
+            del value["id"]
+
+    with dst.begin() as conn:
+        conn.execute(table.insert(), values)
+
+    last_id: int = rows[-1].id
+    return last_id
+
+
+def bind(shard: str) -> Optional[str]:
+    return None if shard == "default" else shard
+
+
+def main() -> None:
+    try:
+        form_id: int = int(sys.argv[1])
+        target: str = sys.argv[2]
+        grace: float = float(sys.argv[3]) if len(sys.argv) > 3 else 5.0
+    except (IndexError, ValueError):
+        print(f"USAGE: {sys.argv[0]} <form id> <shard> [grace seconds]")
+        print()
+        print("Moves the results of a form to another shard while the site is running.")
+        print("Use 'default' as the shard to move the results to the main database.")
+        print("An interrupted move continues where it left off when run again.")
+        sys.exit(1)
+
+    with create_app().app_context():
+        if target != "default" and target not in current_app.config["FORMIE_SHARDS"]:
+            print(f"ERROR: unknown shard {target}", file=sys.stderr)
+            sys.exit(1)
+
+        form = models.Form.query.filter_by(id=form_id).first()
+        if form is None:
+            print(f"ERROR: no form with id {form_id}", file=sys.stderr)
+            sys.exit(1)
+
+        fields = forms.decode_fields(json.loads(form.schema))
+        table = forms.create_model(str(form.id), fields).__table__
+
+        if form.moving_to is None:
+            if form.shard == bind(target):
+                print("Form is already on the given shard.")
+                return
+
+            if sqlalchemy.inspect(models.db.get_engine(bind=bind(target))).has_table(
+                table.name
+            ):
+                print(
+                    f"ERROR: {target} already has a table {table.name}, probably"
+                    " kept from an earlier move. Drop it first.",
+                    file=sys.stderr,
+                )
+                sys.exit(1)
+
+            form.moving_from = form.shard or "default"
+            form.moving_to = target
+            models.db.session.commit()
+        elif form.moving_to != target:
+            print(
+                f"ERROR: form is being moved to {form.moving_to}, finish that first.",
+                file=sys.stderr,
+            )
+            sys.exit(1)
+
+        source: str = form.moving_from
+        src = models.db.get_engine(bind=bind(source))
+        dst = models.db.get_engine(bind=bind(target))
+
+        if form.moved_id is None:
+            table.create(dst, checkfirst=True)
+
+            # Ids are kept until the switch, so an interrupted copy resumes from
+            # the highest id on the target.
+            with dst.connect() as conn:
+                last_id = (
+                    conn.execute(sqlalchemy.func.max(table.c.id).select()).scalar() or 0
+                )
+
+            # Answers keep coming in while copying, stop once drained.
+            while (copied_id := copy_batch(table, src, dst, last_id, True)) is not None:
+                last_id = copied_id
+
+            form.shard = bind(target)
+            form.moved_id = last_id
+            models.db.session.commit()
+
+            # Workers that loaded the form before the switch may still write to the
+            # old shard for a little while.
+            time.sleep(grace)
+
+        # Late answers get new ids, theirs may already be taken on the target.
+        # Progress is recorded after every batch so a rerun doesn't copy them twice.
+        while (
+            copied_id := copy_batch(table, src, dst, form.moved_id, False)
+        ) is not None:
+            form.moved_id = copied_id
+            models.db.session.commit()
+
+        last_id = form.moved_id
+        form.moving_from = form.moving_to = form.moved_id = None
+        models.db.session.commit()
+
+        with src.connect() as conn:
+            late = conn.execute(
+                sqlalchemy.select(sqlalchemy.func.count()).where(table.c.id > last_id)
+            ).scalar()
+
+        # Dropping the old table would fail writers slower than the grace period,
+        # leave it to the admin.
+        print(f"Moved. The old table {table.name} is kept on {source}.")
+        if late:
+            print(
+                f"WARNING: {late} answers reached the old table after the last copy,"
+                f" they have ids above {last_id} there and were not moved."
+            )
+        print("Drop it once no worker writes to it, before moving the form back there.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 
+import json
 import sys
 
-from formie import create_app, models
+from formie import create_app, forms, models
 
 
 def main() -> None:
@@ -15,6 +16,8 @@ def main() -> None:
         print()
         print("0 - full setup")
         print("1 - form access control flags upgrade")
+        print("2 - results sharding upgrade")
+        print("3 - schema hash upgrade")
         sys.exit(1)
 
     if version == 0:
@@ -26,6 +29,20 @@ def main() -> None:
                 conn.execute(
                     "ALTER TABLE Form ADD COLUMN access_control_flags INT NOT NULL DEFAULT 0;"
                 )
+    elif version == 2:
+        with create_app().app_context():
+            with models.db.engine.begin() as conn:
+                conn.execute("ALTER TABLE Form ADD COLUMN shard TEXT;")
+                conn.execute("ALTER TABLE Form ADD COLUMN moving_from TEXT;")
+                conn.execute("ALTER TABLE Form ADD COLUMN moving_to TEXT;")
+                conn.execute("ALTER TABLE Form ADD COLUMN moved_id INT;")
+    elif version == 3:
+        with create_app().app_context():
+            with models.db.engine.begin() as conn:
+                conn.execute("ALTER TABLE Form ADD COLUMN schema_hash TEXT;")
+            for form in models.Form.query.all():
+                form.schema_hash = forms.schema_hash(json.loads(form.schema))
+            models.db.session.commit()
     else:
         print("ERROR: invalid version", file=sys.stderr)
         sys.exit(1)